@@ -26,6 +26,7 @@ def _print_help():
     print("\tset <key> <value>")
     print("\tdel <key>")
     print("\tlist")
+    print("\tcompact")
     print("\texit")
 
 
@@ -40,6 +41,9 @@ def run_command(store: DiskStorage) -> CommandResult:
     if parts[0] == "list":
         print(store.list())
         return CommandResult.OK
+    if parts[0] == "compact":
+        store.compact()
+        return CommandResult.OK
     if parts[0] == "exit":
         return CommandResult.EXIT
     if parts[0] == "get":
@@ -77,7 +81,11 @@ if __name__ == "__main__":
     print("Welcome to PollenStore")
     _print_help()
     store = DiskStorage(args.file)
-    if args.repl:
-        repl(store)
-    else:
-        run_command(store)
+    try:
+        if args.repl:
+            repl(store)
+        else:
+            run_command(store)
+    finally:
+        # writes are buffered, closing the store makes sure they reach the disk
+        store.close()
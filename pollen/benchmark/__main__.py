@@ -17,5 +17,8 @@ if __name__ == "__main__":
         os.remove(file_path)
     except FileNotFoundError:
         pass
-    store = DiskStorage(file_path)
-    bench(store, iterations)
+    disk_store = DiskStorage(file_path)
+    try:
+        bench(disk_store, iterations)
+    finally:
+        disk_store.close()
@@ -1,3 +1,4 @@
+import os
 import random
 import string
 import time
@@ -6,13 +7,16 @@ import time
 def bench(store, iterations):
     KB = 2**10
     SIZES = [KB, 5 * KB, 100 * KB, KB]
-    data = [str(random.randbytes(s)) for s in SIZES]
-    keys = ["".join(random.choices(string.ascii_letters)) for _ in range(iterations)]
+    # hex doubles the length, so half the bytes give a value of the stated size
+    data = [os.urandom(s // 2).hex() for s in SIZES]
+    keys = random.choices(string.ascii_letters, k=iterations)
+    # pairs and the bound method are prepared outside the timed loop, so it measures
+    # the store and not the indexing
+    pairs = [(keys[i % len(keys)], data[i % len(data)]) for i in range(iterations)]
+    store_set = store.set
     start = time.perf_counter()
-    for i in range(iterations):
-        key = keys[i % len(keys)]
-        value = data[i % len(data)]
-        store.set(key, value)
+    for key, value in pairs:
+        store_set(key, value)
     dt = time.perf_counter() - start
     print(f"Time: {dt:.2f}s")
     print(f"Iterations: {iterations:,}")
@@ -3,9 +3,10 @@ disk_store module implements DiskStorage class which implements the KV store on
 disk
 
 DiskStorage provides two simple operations to get and set key value pairs. Both key and
-value needs to be of string type. All the data is persisted to disk. During startup,
-DiskStorage loads all the existing KV pair metadata.  It will throw an error if the
-file is invalid or corrupt.
+value needs to be of string type. All the data is persisted to disk. Writes are
+buffered and persisted in batches by a background thread, call `sync` (or `close`) to
+make sure all of them reached the disk. During startup, DiskStorage loads all the
+existing KV pair metadata. It will throw an error if the file is invalid or corrupt.
 
 Do note that if the database file is large, then the initialisation will take time
 accordingly. The initialisation is also a blocking operation, till it is completed
@@ -20,11 +21,24 @@ Typical usage example:
     disk["hamlet"] = "shakespeare"
 """
 
+import mmap
 import os.path
+import queue
+import sys
+import threading
 import time
-from dataclasses import dataclass
+import weakref
+from array import array
+from bisect import bisect_right
+from typing import Callable, Optional, Union
 
-from pollen.format import HEADER_SIZE, decode_header, decode_kv, encode_kv
+from pollen.format import (
+    HEADER_SIZE,
+    HEADER_STRUCT,
+    TOMBSTONE,
+    encode_kv_iov_bytes,
+    encode_tombstone,
+)
 
 # DiskStorage is a Log-Structured Hash Table as described in the BitCask paper. We
 # keep appending the data to a file, like a log. DiskStorage maintains an in-memory
@@ -53,11 +67,233 @@ from pollen.format import HEADER_SIZE, decode_header, decode_kv, encode_kv
 # Read the paper for more details: https://riak.com/assets/bitcask-intro.pdf
 
 
-@dataclass
-class KeyEntry:
-    timestamp: int
-    position: int
-    size: int
+# Windows opens files in text mode unless told otherwise
+_O_BINARY = getattr(os, "O_BINARY", 0)
+
+# max number of bytes handed to the writer thread but not synced yet, set() waits for
+# the writer once there is more, so a fast producer cannot outrun the disk unbounded
+_MAX_PENDING = 8 << 20
+
+# max number of buffers in a single writev() call
+_IOV_MAX = 1024
+
+# bound once, set() is hot enough for the module attribute lookup to show up
+_now = time.time
+
+
+def _seek_read(fd: int, size: int, position: int, /) -> bytes:
+    os.lseek(fd, position, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+# single positional read where available (not on Windows)
+_pread: Callable[[int, int, int], bytes] = getattr(os, "pread", _seek_read)
+
+
+def _write_all(fd: int, data: Union[bytes, bytearray, memoryview]) -> None:
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _writev_all(fd: int, buffers: list[bytes]) -> None:
+    if not hasattr(os, "writev"):
+        _write_all(fd, b"".join(buffers))
+        return
+    i = 0
+    while i < len(buffers):
+        iov = buffers[i : i + _IOV_MAX]
+        written = os.writev(fd, iov)
+        if written == sum(map(len, iov)):
+            i += len(iov)
+            continue
+        # writev can stop in the middle of a buffer, skip what was written and
+        # finish that buffer on its own
+        while written >= len(buffers[i]):
+            written -= len(buffers[i])
+            i += 1
+        _write_all(fd, memoryview(buffers[i])[written:])
+        i += 1
+
+
+def _sync_data(fd: int) -> None:
+    """Make sure the written data of `fd` is on the disk."""
+    if sys.platform == "darwin":
+        # fsync on macOS only hands the data to the drive, which may keep it in its
+        # cache, F_FULLFSYNC flushes the drive cache too
+        import fcntl
+
+        fcntl.fcntl(fd, fcntl.F_FULLFSYNC)
+    elif hasattr(os, "fdatasync"):
+        # the log is append-only, so only data (and size) need to be synced, not the
+        # rest of the metadata like mtime
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def _sync_dir(path: str) -> None:
+    """Make sure the directory entry of `path`, e.g. after a rename, is on the disk."""
+    if os.name == "nt":
+        # directories cannot be opened on Windows
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Batch:
+    """
+    Records appended to the log, kept as separate buffers (header, key and value of
+    each record) so they can be written with writev() without joining them first.
+    """
+
+    def __init__(self, position: int):
+        # position of the batch in the log
+        self.position = position
+        self.size = 0
+        self.buffers: list[bytes] = []
+        # offset of each buffer within the batch
+        self.offsets: list[int] = []
+
+    def extend(self, buffers: list[bytes]) -> None:
+        for data in buffers:
+            if data:
+                self.offsets.append(self.size)
+                self.buffers.append(data)
+                self.size += len(data)
+
+    def read(self, position: int, size: int) -> bytes:
+        if size == 0:
+            # an empty value at the end of the log points past the last buffer, or
+            # into an empty batch
+            return b""
+        i = bisect_right(self.offsets, position - self.position) - 1
+        start = position - self.position - self.offsets[i]
+        data = self.buffers[i]
+        if start == 0 and len(data) == size:
+            # reads of a whole key or value, no copy needed
+            return data
+        parts = []
+        while size > 0:
+            part = self.buffers[i][start : start + size]
+            parts.append(part)
+            size -= len(part)
+            start = 0
+            i += 1
+        return b"".join(parts)
+
+
+class _Log:
+    """
+    The open log file and the background thread writing batches to it. Kept apart
+    from DiskStorage, so the thread does not keep an unclosed store alive - once the
+    store is garbage collected (or at exit), `close` writes what is left and stops it.
+    """
+
+    def __init__(self, wfd: int, rfd: int, size: int, drop_written_pages: bool):
+        self.wfd = wfd
+        self.rfd = rfd
+        self.drop_written_pages = drop_written_pages
+        # Positions in the log:
+        #   [0, synced_position) - durably written to the file
+        #   [synced_position, wbuf.position) - batches queued for the writer thread
+        #   [wbuf.position, wbuf.position + wbuf.size) - records in wbuf
+        self.synced_position = size
+        self.wbuf = _Batch(size)
+        # batches handed to the writer but not synced yet, guarded by synced, which is
+        # notified whenever synced_position moves
+        self.pending: list[_Batch] = []
+        self.pending_size = 0
+        self.synced = threading.Condition()
+        self.error: Optional[BaseException] = None
+        self.queue: "queue.SimpleQueue[Optional[_Batch]]" = queue.SimpleQueue()
+        self.writer: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.writer = threading.Thread(target=self._write_batches, daemon=True)
+        self.writer.start()
+
+    def flush(self) -> None:
+        """Hand the buffered records to the writer thread, does not wait for them."""
+        if self.error is not None:
+            raise self.error
+        if not self.wbuf.size:
+            return
+        batch = self.wbuf
+        with self.synced:
+            self.pending.append(batch)
+            self.pending_size += batch.size
+        self.queue.put(batch)
+        self.wbuf = _Batch(batch.position + batch.size)
+        if self.pending_size > _MAX_PENDING:
+            with self.synced:
+                while self.pending_size > _MAX_PENDING and self.error is None:
+                    self.synced.wait()
+
+    def sync(self) -> None:
+        """Write all buffered records to the disk and wait until they are synced."""
+        self.flush()
+        with self.synced:
+            while self.synced_position < self.wbuf.position:
+                if self.error is not None:
+                    raise self.error
+                self.synced.wait()
+
+    def _write_batches(self) -> None:
+        """Writer thread: writes and syncs the queued batches until stopped by None."""
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            batches = [batch]
+            stop = False
+            # everything queued meanwhile is written with the same sync
+            while True:
+                try:
+                    batch = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if batch is None:
+                    stop = True
+                    break
+                batches.append(batch)
+            start = batches[0].position
+            size = sum(batch.size for batch in batches)
+            try:
+                _writev_all(self.wfd, [d for batch in batches for d in batch.buffers])
+                _sync_data(self.wfd)
+                if self.drop_written_pages:
+                    # the pages are clean after the sync, so the kernel can drop them
+                    os.posix_fadvise(self.wfd, start, size, os.POSIX_FADV_DONTNEED)
+            except BaseException as ex:
+                # nothing after a failed batch can be written without leaving a hole,
+                # the error is raised on the next flush or sync
+                with self.synced:
+                    self.error = ex
+                    self.synced.notify_all()
+                return
+            with self.synced:
+                del self.pending[: len(batches)]
+                self.pending_size -= size
+                self.synced_position = start + size
+                self.synced.notify_all()
+            if stop:
+                return
+
+    def close(self) -> None:
+        """Write the remaining records, stop the writer thread and close the files."""
+        try:
+            self.sync()
+        finally:
+            if self.writer is not None:
+                self.queue.put(None)
+                self.writer.join()
+            os.close(self.wfd)
+            os.close(self.rfd)
 
 
 class DiskStorage:
@@ -68,76 +304,294 @@ class DiskStorage:
         file_name (str): name of the file where all the data will be written. Just
             passing the file name will save the data in the current directory. You may
             pass the full file location too.
+        use_mmap (bool): serve reads from a memory map of the file. If disabled, each
+            read is a single pread() call instead. Useful where mapping a growing file
+            is undesirable, e.g. on Windows.
+        drop_written_pages (bool): ask the OS to evict written records from the page
+            cache once they are on the disk. Keeps the cache for the hot records when
+            values are large and seldom read back.
     """
 
-    def __init__(self, file_name: str):
+    def __init__(
+        self, file_name: str, use_mmap: bool = True, drop_written_pages: bool = False
+    ):
         self.file_name = file_name
-        self.key_dir: dict[str, KeyEntry] = {}
+        self._use_mmap = use_mmap
+        self._drop_written_pages = drop_written_pages and hasattr(os, "posix_fadvise")
+        # KeyDir is stored as columns (struct of arrays) instead of an object per key,
+        # the index maps keys to slots, freed slots are reused
+        self._idx: dict[str, int] = {}
+        self._ts = array("q")
+        self._pos = array("q")
+        self._sz = array("q")
+        # key sizes let get() slice the value without reading the header
+        self._ks = array("q")
+        self._free: list[int] = []
         self.write_position: int = 0
-        if os.path.exists(file_name):
-            self._init_key_dir()
+        # group commit: appended records are buffered, once the buffer grows past the
+        # threshold (or on sync/close) it is handed to the writer thread, which writes
+        # all batches queued so far with a single sync
+        self._wbuf_threshold = 1 << 20
+        exists = os.path.exists(file_name)
+        wfd, rfd = self._open()
+        self._log = _Log(wfd, rfd, os.fstat(wfd).st_size, self._drop_written_pages)
+        # reads of flushed records are served from a read-only memory map of the file
+        self._mm: Optional[mmap.mmap] = None
+        self._mapped_size: int = 0
+        try:
+            # the file is mapped for loading even without use_mmap, it is the fastest
+            # way to parse it
+            self._map()
+            if exists:
+                self._advise(sequential=True)
+                self._init_key_dir()
+        except BaseException:
+            self._unmap()
+            os.close(wfd)
+            os.close(rfd)
+            raise
+        if not use_mmap:
+            self._unmap()
+        self._advise(sequential=False)
+        self._log.start()
+        # daemon threads are killed at exit, so the log is closed at exit if the store
+        # was not closed, or once the store is garbage collected
+        self._close_log = weakref.finalize(self, self._log.close)
 
+    def _open(self) -> tuple[int, int]:
         try:
-            self.file = open(self.file_name, mode="a+b")
+            # raw fds without Python's buffered file objects, records are already
+            # batched in the write buffer; O_APPEND makes sure writes always land at
+            # the end of the log
+            wfd = os.open(
+                self.file_name,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT | _O_BINARY,
+                0o644,
+            )
+            rfd = os.open(self.file_name, os.O_RDONLY | _O_BINARY)
         except OSError as ex:
-            raise ValueError(f'Failed to open "{file_name}"') from ex
+            raise ValueError(f'Failed to open "{self.file_name}"') from ex
+        return wfd, rfd
+
+    def _advise(self, sequential: bool) -> None:
+        """
+        Tell the OS how the file is read. Reads are driven by keys, read-ahead would be
+        mostly wasted, except while loading and compacting, which read it in order.
+        """
+        if hasattr(os, "posix_fadvise"):
+            advice = os.POSIX_FADV_SEQUENTIAL if sequential else os.POSIX_FADV_RANDOM
+            os.posix_fadvise(self._log.rfd, 0, 0, advice)
+        if self._mm is not None and hasattr(mmap, "MADV_RANDOM"):
+            self._mm.madvise(mmap.MADV_SEQUENTIAL if sequential else mmap.MADV_RANDOM)
 
-    def _write(self, data: bytes) -> None:
-        self.file.write(data)
-        self.file.flush()
-        os.fsync(self.file.fileno())
+    def _remap(self) -> None:
+        """Map the file again if it grew past the current mapping."""
+        if self._use_mmap and self._log.synced_position > self._mapped_size:
+            self._map()
+
+    def _map(self) -> None:
+        self._unmap()
+        if self._log.synced_position == 0:
+            # empty files cannot be mapped
+            return
+        self._mm = mmap.mmap(self._log.rfd, 0, access=mmap.ACCESS_READ)
+        self._mapped_size = len(self._mm)
+        if hasattr(mmap, "MADV_RANDOM"):
+            # reads are driven by keys, read-ahead would be mostly wasted
+            self._mm.madvise(mmap.MADV_RANDOM)
+
+    def _unmap(self) -> None:
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+            self._mapped_size = 0
+
+    def sync(self) -> None:
+        """Write all buffered records to the disk and wait until they are synced."""
+        self._log.sync()
+        self._remap()
 
     def list(self) -> list[str]:
-        return list(self.key_dir.keys())
+        return list(self._idx)
+
+    def _read(self, position: int, size: int) -> bytes:
+        log = self._log
+        if position >= log.wbuf.position:
+            return log.wbuf.read(position, size)
+        if position >= log.synced_position:
+            with log.synced:
+                for batch in log.pending:
+                    if batch.position <= position < batch.position + batch.size:
+                        return batch.read(position, size)
+            # synced by the writer in the meantime
+        if position + size > self._mapped_size:
+            self._remap()
+        if self._mm is not None:
+            return self._mm[position : position + size]
+        return _pread(log.rfd, size, position)
+
+    def _put(
+        self, key: str, key_size: int, timestamp: int, position: int, size: int
+    ) -> None:
+        slot = self._idx.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._pos)
+                self._ts.append(0)
+                self._pos.append(0)
+                self._sz.append(0)
+                self._ks.append(0)
+            self._idx[key] = slot
+        self._ts[slot] = timestamp
+        self._pos[slot] = position
+        self._sz[slot] = size
+        self._ks[slot] = key_size
+
+    def _drop(self, key: str) -> None:
+        slot = self._idx.pop(key, None)
+        if slot is not None:
+            self._free.append(slot)
 
     def _init_key_dir(self) -> None:
         print(f"--- loading DB from {self.file_name} ---")
-        with open(self.file_name, "rb") as f:
-            while header_bytes := f.read(HEADER_SIZE):
-                timestamp, key_size, value_size = decode_header(data=header_bytes)
-                key_bytes = f.read(key_size)
-                f.seek(value_size, 1)
-                key = key_bytes.decode("utf-8")
-                total_size = HEADER_SIZE + key_size + value_size
-                kv = KeyEntry(
-                    timestamp=timestamp,
-                    position=self.write_position,
-                    size=total_size,
-                )
-                # deleted keys will have empty value
-                if value_size > 0:
-                    self.key_dir[key] = kv
-                else:
-                    self.key_dir.pop(key)
-                self.write_position += total_size
-        print(f"--- loaded {len(self.key_dir):,} keys ---")
+        # parse the mapped file in place, no read() calls or header copies
+        unpack_header = HEADER_STRUCT.unpack_from
+        position = 0
+        # an empty file is not mapped
+        mm = self._mm if self._mm is not None else b""
+        while position < len(mm):
+            timestamp, key_size, value_size = unpack_header(mm, position)
+            key_position = position + HEADER_SIZE
+            key = mm[key_position : key_position + key_size].decode("utf-8")
+            if value_size == TOMBSTONE:
+                self._drop(key)
+                position += HEADER_SIZE + key_size
+                continue
+            total_size = HEADER_SIZE + key_size + value_size
+            # older versions marked deleted keys with an empty value
+            if value_size > 0:
+                self._put(key, key_size, timestamp, position, total_size)
+            else:
+                self._drop(key)
+            position += total_size
+        self.write_position = position
+        print(f"--- loaded {len(self._idx):,} keys ---")
 
     def set(self, key: str, value: str) -> None:
-        ts = int(time.time())
-        size, data = encode_kv(ts, key, value)
-        self._write(data)
-        self.key_dir[key] = KeyEntry(ts, self.write_position, size)
+        ts = int(_now())
+        # header, key and value are kept as they are, the record is never joined
+        key_bytes = key.encode()
+        size, buffers = encode_kv_iov_bytes(ts, key_bytes, value)
+        wbuf = self._log.wbuf
+        wbuf.extend(buffers)
+        self._put(key, len(key_bytes), ts, self.write_position, size)
         self.write_position += size
+        if wbuf.size >= self._wbuf_threshold:
+            self._log.flush()
 
     def get(self, key: str) -> str:
-        entry = self.key_dir.get(key)
-        if not entry:
-            return ""
-        self.file.seek(entry.position)
-        ts, key, value = decode_kv(self.file.read(entry.size))
-        return value
+        return self.get_bytes(key).decode()
+
+    def get_bytes(self, key: str) -> bytes:
+        """
+        Same as `get`, but returns the raw UTF-8 encoded value. Skips decoding the
+        value, which is useful for large values that will be written somewhere as
+        bytes anyway.
+        """
+        slot = self._idx.get(key)
+        if slot is None:
+            return b""
+        # the value is at the end of the record, right after the header and the key
+        position = self._pos[slot]
+        value_position = position + HEADER_SIZE + self._ks[slot]
+        return self._read(value_position, position + self._sz[slot] - value_position)
 
     def remove(self, key: str) -> None:
-        if key in self.key_dir:
-            # overwrite with empty value on disk
-            self.set(key, "")
+        if key in self._idx:
+            # mark as deleted on disk
+            data = encode_tombstone(int(_now()), key)
+            wbuf = self._log.wbuf
+            wbuf.extend([data])
+            self.write_position += len(data)
             # remove from in-memory storage
-            del self.key_dir[key]
+            self._drop(key)
+            if wbuf.size >= self._wbuf_threshold:
+                self._log.flush()
+
+    def compact(self) -> None:
+        """
+        Rewrites the file keeping only the latest record of each key. Reclaims the space
+        taken by overwritten and deleted keys and makes the next startup faster.
+        """
+        # also leaves the writer thread idle, so the files can be swapped under it
+        self.sync()
+        compact_name = f"{self.file_name}.compact"
+        # copy records in file order, so the old file is read sequentially
+        self._advise(sequential=True)
+        slots = sorted(self._idx.values(), key=self._pos.__getitem__)
+        # slots are renumbered in file order, which also drops the free ones
+        new_slots: dict[int, int] = {}
+        ts, pos, sz, ks = array("q"), array("q"), array("q"), array("q")
+        position = 0
+        fd = os.open(
+            compact_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY, 0o644
+        )
+        try:
+            buffer = bytearray()
+            for slot in slots:
+                size = self._sz[slot]
+                buffer += self._read(self._pos[slot], size)
+                new_slots[slot] = len(pos)
+                ts.append(self._ts[slot])
+                pos.append(position)
+                sz.append(size)
+                ks.append(self._ks[slot])
+                position += size
+                if len(buffer) >= self._wbuf_threshold:
+                    _write_all(fd, buffer)
+                    buffer.clear()
+            _write_all(fd, buffer)
+            _sync_data(fd)
+        except BaseException:
+            os.close(fd)
+            os.remove(compact_name)
+            self._advise(sequential=False)
+            raise
+        os.close(fd)
+
+        # files cannot be replaced while open on Windows
+        self._close_files()
+        try:
+            os.replace(compact_name, self.file_name)
+        except BaseException:
+            # keep using the original file
+            self._log.wfd, self._log.rfd = self._open()
+            self._remap()
+            self._advise(sequential=False)
+            os.remove(compact_name)
+            raise
+        self._log.wfd, self._log.rfd = self._open()
+        self._idx = {key: new_slots[slot] for key, slot in self._idx.items()}
+        self._ts, self._pos, self._sz, self._ks = ts, pos, sz, ks
+        self._free = []
+        self.write_position = position
+        self._log.synced_position = position
+        self._log.wbuf = _Batch(position)
+        self._remap()
+        self._advise(sequential=False)
+        # the rename itself is only durable once the directory is synced
+        _sync_dir(self.file_name)
+
+    def _close_files(self) -> None:
+        os.close(self._log.wfd)
+        self._unmap()
+        os.close(self._log.rfd)
 
     def close(self) -> None:
-        self.file.flush()
-        os.fsync(self.file.fileno())
-        self.file.close()
+        self._unmap()
+        self._close_log()
 
     def __setitem__(self, key: str, value: str) -> None:
         return self.set(key, value)
@@ -23,9 +23,11 @@ In the above, the language deals with all the complexities:
 Unfortunately, when it comes to disks, we have to do all this by ourselves, write
 code which can allocate space, convert objects to/from bytes and many other operations.
 
-format module provides two functions which help us with serialisation of data.
+format module provides functions which help us with serialisation of data.
 
     encode_kv - takes the key value pair and encodes them into bytes
+    encode_kv_iov - same as encode_kv, but returns header, key and value separately
+    encode_tombstone - encodes a record marking a key as deleted
     decode_kv - takes a bunch of bytes and decodes them into key value pairs
 
 **workshop note**
@@ -42,31 +44,65 @@ import typing
 # little-endian, 3x unsigned long
 HEADER_FORMAT = "<3L"
 HEADER_SIZE: typing.Final[int] = 12
+# value size reserved to mark deleted keys, a tombstone record has no value bytes
+TOMBSTONE: typing.Final[int] = 0xFFFFFFFF
+# compiled once, so the format string is not parsed again on every call
+HEADER_STRUCT: typing.Final[struct.Struct] = struct.Struct(HEADER_FORMAT)
+
+# The helpers below run once per operation, so they are kept lean: the struct methods
+# are bound once, and str.encode/bytes.decode are called without arguments, which
+# takes CPython's UTF-8 fast path without parsing keyword arguments.
+_pack_header = HEADER_STRUCT.pack
+_unpack_header = HEADER_STRUCT.unpack_from
 
 
 def encode_header(timestamp: int, key_size: int, value_size: int) -> bytes:
     # note that the call will fail if the values are too large
     # (no silent fails here)
-    return struct.pack(HEADER_FORMAT, timestamp, key_size, value_size)
+    return _pack_header(timestamp, key_size, value_size)
 
 
 def encode_kv(timestamp: int, key: str, value: str) -> tuple[int, bytes]:
-    header: bytes = encode_header(timestamp, len(key), len(value))
-    data: bytes = b"".join(
-        [str.encode(key, encoding="utf-8"), str.encode(value, encoding="utf-8")]
-    )
-    return HEADER_SIZE + len(data), header + data
+    key_bytes: bytes = key.encode()
+    value_bytes: bytes = value.encode()
+    header: bytes = _pack_header(timestamp, len(key_bytes), len(value_bytes))
+    data: bytes = b"".join((header, key_bytes, value_bytes))
+    return len(data), data
+
+
+def encode_kv_iov(timestamp: int, key: str, value: str) -> tuple[int, list[bytes]]:
+    """
+    Encodes the key value pair as three buffers - header, key and value - which can be
+    written with a single os.writev call. The record is never joined into one buffer,
+    which saves a copy of the value. Returns the size of the record and the buffers.
+    """
+    return encode_kv_iov_bytes(timestamp, key.encode(), value)
+
+
+def encode_kv_iov_bytes(
+    timestamp: int, key_bytes: bytes, value: str
+) -> tuple[int, list[bytes]]:
+    """Same as encode_kv_iov, but takes the already encoded key."""
+    value_bytes: bytes = value.encode()
+    key_size = len(key_bytes)
+    value_size = len(value_bytes)
+    header: bytes = _pack_header(timestamp, key_size, value_size)
+    return HEADER_SIZE + key_size + value_size, [header, key_bytes, value_bytes]
+
+
+def encode_tombstone(timestamp: int, key: str) -> bytes:
+    """Encodes a record marking `key` as deleted, it is just the header and the key."""
+    key_bytes: bytes = key.encode()
+    return _pack_header(timestamp, len(key_bytes), TOMBSTONE) + key_bytes
 
 
 def decode_kv(data: bytes) -> tuple[int, str, str]:
-    timestamp, key_size, value_size = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
-    key_bytes: bytes = data[HEADER_SIZE : HEADER_SIZE + key_size]
-    value_bytes: bytes = data[HEADER_SIZE + key_size :]
-    key: str = key_bytes.decode("utf-8")
-    value: str = value_bytes.decode("utf-8")
+    timestamp, key_size, value_size = _unpack_header(data)
+    value_position = HEADER_SIZE + key_size
+    key: str = data[HEADER_SIZE:value_position].decode()
+    value: str = data[value_position:].decode()
     return timestamp, key, value
 
 
 def decode_header(data: bytes) -> tuple[int, int, int]:
-    timestamp, key_size, value_size = struct.unpack(HEADER_FORMAT, data)
-    return timestamp, key_size, value_size
+    return _unpack_header(data)
@@ -1,10 +1,18 @@
+import gc
 import os
+import struct
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 from typing import Iterator
 
 import pytest
 
+from pollen import disk_store
 from pollen.disk_store import DiskStorage
+from pollen.format import encode_kv
 
 
 @pytest.fixture(scope="function")
@@ -32,6 +40,77 @@ def test_get(temp_db_path: str) -> None:
     assert store.get("name") == "jojo"
     store.close()
 
+
+def test_get_bytes(temp_db_path: str) -> None:
+    store = DiskStorage(file_name=temp_db_path)
+    store.set("name", "jojo")
+    assert store.get_bytes("name") == b"jojo"
+    assert store.get_bytes("missing") == b""
+    store.sync()
+    assert store.get_bytes("name") == b"jojo"
+    store.close()
+
+
+def test_pread(temp_db_path: str) -> None:
+    """Test reading without a memory map."""
+    store = DiskStorage(file_name=temp_db_path, use_mmap=False)
+    store.set("name", "jojo")
+    store.sync()
+    store.set("other", "dio")
+    assert store.get("name") == "jojo"
+    assert store.get("other") == "dio"
+    store.close()
+
+    store = DiskStorage(file_name=temp_db_path, use_mmap=False)
+    assert store.get("name") == "jojo"
+    assert store.get("other") == "dio"
+    store.close()
+
+
+@pytest.mark.skipif(not hasattr(os, "posix_fadvise"), reason="needs posix_fadvise")
+def test_drop_written_pages(temp_db_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that synced batches are dropped from the page cache."""
+    calls = []
+    posix_fadvise = os.posix_fadvise
+
+    def record_fadvise(fd: int, offset: int, length: int, advice: int) -> None:
+        calls.append((offset, length, advice))
+        posix_fadvise(fd, offset, length, advice)
+
+    monkeypatch.setattr(os, "posix_fadvise", record_fadvise)
+    store = DiskStorage(file_name=temp_db_path, drop_written_pages=True)
+    store.set("name", "jojo")
+    store.sync()
+    size = os.path.getsize(temp_db_path)
+    assert (0, size, os.POSIX_FADV_DONTNEED) in calls
+    assert store.get("name") == "jojo"
+    store.close()
+
+
+@pytest.mark.skipif(not hasattr(os, "posix_fadvise"), reason="needs posix_fadvise")
+def test_read_advice(temp_db_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the file is read ahead while loading, but not afterwards."""
+    store = DiskStorage(file_name=temp_db_path)
+    store.set("name", "jojo")
+    store.close()
+
+    calls = []
+    posix_fadvise = os.posix_fadvise
+
+    def record_fadvise(fd: int, offset: int, length: int, advice: int) -> None:
+        calls.append(advice)
+        posix_fadvise(fd, offset, length, advice)
+
+    monkeypatch.setattr(os, "posix_fadvise", record_fadvise)
+    store = DiskStorage(file_name=temp_db_path)
+    assert calls == [os.POSIX_FADV_SEQUENTIAL, os.POSIX_FADV_RANDOM]
+    calls.clear()
+    store.compact()
+    assert calls == [os.POSIX_FADV_SEQUENTIAL, os.POSIX_FADV_RANDOM]
+    assert store.get("name") == "jojo"
+    store.close()
+
+
 def test_remove(temp_db_path: str) -> None:
     store = DiskStorage(file_name=temp_db_path)
     store.set("name", "jojo")
@@ -45,6 +124,16 @@ def test_remove(temp_db_path: str) -> None:
     store.close()
 
 
+def test_remove_legacy(temp_db_path: str) -> None:
+    """Test that empty values written by older versions still delete the key."""
+    with open(temp_db_path, "wb") as f:
+        f.write(encode_kv(1, "name", "jojo")[1])
+        f.write(encode_kv(2, "name", "")[1])
+    store = DiskStorage(file_name=temp_db_path)
+    assert store.list() == []
+    store.close()
+
+
 def test_list(temp_db_path: str) -> None:
     store = DiskStorage(file_name=temp_db_path)
     store.set("alpha", "xyz")
@@ -53,6 +142,9 @@ def test_list(temp_db_path: str) -> None:
     assert set(store.list()) == {"alpha", "beta"}
     store.remove("alpha")
     assert set(store.list()) == {"beta"}
+    # setting a key again after removing another one does not duplicate it
+    store.set("beta", "qux")
+    assert store.list() == ["beta"]
     store.close()
 
     # check persistence
@@ -99,3 +191,217 @@ def test_persistence(temp_db_path: str) -> None:
     for k, v in tests.items():
         assert store.get(k) == v
     store.close()
+
+
+def test_buffered_writes(temp_db_path: str) -> None:
+    """Test that buffered records are readable before and after sync."""
+    store = DiskStorage(file_name=temp_db_path)
+    store.set("name", "jojo")
+    assert os.path.getsize(temp_db_path) == 0
+    assert store.get("name") == "jojo"
+    store.sync()
+    assert os.path.getsize(temp_db_path) > 0
+    store.set("other", "dio")
+    assert store.get("name") == "jojo"
+    assert store.get("other") == "dio"
+    store.close()
+
+    store = DiskStorage(file_name=temp_db_path)
+    assert store.get("name") == "jojo"
+    assert store.get("other") == "dio"
+    store.close()
+
+
+@pytest.mark.skipif(not hasattr(os, "writev"), reason="needs writev")
+def test_partial_writes(temp_db_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that records are written whole when writev stops in the middle."""
+    writev = os.writev
+
+    def short_writev(fd: int, buffers: list[bytes]) -> int:
+        # at most 7 bytes, which stops inside headers, keys and values alike
+        data = b"".join(buffers)[:7]
+        return writev(fd, [data])
+
+    monkeypatch.setattr(os, "writev", short_writev)
+    store = DiskStorage(file_name=temp_db_path)
+    for i in range(100):
+        store.set(f"key{i}", f"value{i}")
+    store.close()
+
+    store = DiskStorage(file_name=temp_db_path)
+    for i in range(100):
+        assert store.get(f"key{i}") == f"value{i}"
+    store.close()
+
+
+def test_empty_value(temp_db_path: str) -> None:
+    """Test that an empty value is readable before and after sync."""
+    store = DiskStorage(file_name=temp_db_path)
+    store.set("name", "")
+    assert store.get("name") == ""
+    store.sync()
+    assert store.get("name") == ""
+    store.set("other", "dio")
+    store.set("empty", "")
+    assert store.get("empty") == ""
+    assert store.get("other") == "dio"
+    store.close()
+
+
+def test_write_error(temp_db_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a failed write in the writer thread is raised to the caller."""
+
+    def failing_sync(fd: int) -> None:
+        raise OSError("disk full")
+
+    monkeypatch.setattr(disk_store, "_sync_data", failing_sync)
+    store = DiskStorage(file_name=temp_db_path)
+    store.set("name", "jojo")
+    with pytest.raises(OSError, match="disk full"):
+        store.sync()
+    # a full write buffer is handed to the writer right away
+    with pytest.raises(OSError, match="disk full"):
+        store.set("other", "x" * (1 << 20))
+    with pytest.raises(OSError, match="disk full"):
+        store.close()
+
+
+def test_backpressure(temp_db_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that writes wait for a slow disk once too much data is pending."""
+
+    def slow_sync(fd: int) -> None:
+        time.sleep(0.01)
+
+    monkeypatch.setattr(disk_store, "_sync_data", slow_sync)
+    monkeypatch.setattr(disk_store, "_MAX_PENDING", 2 << 20)
+    store = DiskStorage(file_name=temp_db_path)
+    for i in range(20):
+        store.set(f"key{i}", "x" * (1 << 20))
+        assert store._log.pending_size <= 2 << 20
+    store.close()
+
+
+def test_collect_without_close(temp_db_path: str) -> None:
+    """Test that an unclosed store writes its records once garbage collected."""
+    threads = threading.active_count()
+    store = DiskStorage(file_name=temp_db_path)
+    store.set("name", "jojo")
+    del store
+    gc.collect()
+    assert threading.active_count() == threads
+    store = DiskStorage(file_name=temp_db_path)
+    assert store.get("name") == "jojo"
+    store.close()
+
+
+def test_corrupt_log(temp_db_path: str) -> None:
+    """Test that a store failing to load does not leave the writer thread running."""
+    with open(temp_db_path, "wb") as f:
+        f.write(b"bad")
+    threads = threading.active_count()
+    with pytest.raises(struct.error):
+        DiskStorage(file_name=temp_db_path)
+    assert threading.active_count() == threads
+
+
+def test_exit_without_close(temp_db_path: str) -> None:
+    """Test that buffered records are written when the store is not closed."""
+    code = (
+        "from pollen.disk_store import DiskStorage\n"
+        f"DiskStorage(file_name={temp_db_path!r}).set('name', 'jojo')\n"
+    )
+    root = os.path.dirname(os.path.dirname(disk_store.__file__))
+    subprocess.run([sys.executable, "-c", code], cwd=root, check=True)
+    store = DiskStorage(file_name=temp_db_path)
+    assert store.get("name") == "jojo"
+    store.close()
+
+
+def test_large_values(temp_db_path: str) -> None:
+    """Test reading records written by the writer thread while the store is open."""
+    store = DiskStorage(file_name=temp_db_path)
+    tests = {f"key{i}": str(i) * 300_000 for i in range(5)}
+    for k, v in tests.items():
+        store.set(k, v)
+    # records may still be queued for the writer, or already written
+    for k, v in tests.items():
+        assert store.get(k) == v
+    store.sync()
+    assert os.path.getsize(temp_db_path) > 0
+    for k, v in tests.items():
+        assert store.get(k) == v
+    store.close()
+
+
+def test_many_keys(temp_db_path: str) -> None:
+    store = DiskStorage(file_name=temp_db_path)
+    for i in range(3000):
+        store.set(f"key{i}", str(i))
+    for i in range(3000):
+        assert store.get(f"key{i}") == str(i)
+        assert store.get(f"missing{i}") == ""
+    store.close()
+
+    store = DiskStorage(file_name=temp_db_path)
+    assert len(store.list()) == 3000
+    assert store.get("key1234") == "1234"
+    store.close()
+
+
+def test_unicode(temp_db_path: str) -> None:
+    store = DiskStorage(file_name=temp_db_path)
+    store.set("včela", "med 🍯")
+    assert store.get("včela") == "med 🍯"
+    store.close()
+
+    store = DiskStorage(file_name=temp_db_path)
+    assert store.get("včela") == "med 🍯"
+    store.close()
+
+
+def test_compact(temp_db_path: str) -> None:
+    store = DiskStorage(file_name=temp_db_path)
+    for i in range(100):
+        store.set("alpha", str(i))
+    store.set("beta", "xyz")
+    store.set("gamma", "foo")
+    store.remove("gamma")
+    store.sync()
+    size = os.path.getsize(temp_db_path)
+    store.compact()
+    assert os.path.getsize(temp_db_path) < size
+    assert store.get("alpha") == "99"
+    assert store.get("beta") == "xyz"
+    assert set(store.list()) == {"alpha", "beta"}
+    store.set("gamma", "bar")
+    assert store.get("gamma") == "bar"
+    store.close()
+
+    store = DiskStorage(file_name=temp_db_path)
+    assert store.get("alpha") == "99"
+    assert store.get("gamma") == "bar"
+    assert set(store.list()) == {"alpha", "beta", "gamma"}
+    store.close()
+
+
+def test_compact_failure(temp_db_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the store keeps working with the original file if compact fails."""
+    store = DiskStorage(file_name=temp_db_path)
+    store.set("alpha", "xyz")
+    store.set("alpha", "foo")
+
+    def failing_replace(src: str, dst: str) -> None:
+        raise OSError("replace failed")
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    with pytest.raises(OSError, match="replace failed"):
+        store.compact()
+    assert not os.path.exists(f"{temp_db_path}.compact")
+    assert store.get("alpha") == "foo"
+    store.set("beta", "bar")
+    store.close()
+
+    store = DiskStorage(file_name=temp_db_path)
+    assert store.get("alpha") == "foo"
+    assert store.get("beta") == "bar"
+    store.close()
@@ -8,10 +8,14 @@ import pytest
 
 from pollen.format import (
     HEADER_SIZE,
+    TOMBSTONE,
     decode_header,
     decode_kv,
     encode_header,
     encode_kv,
+    encode_kv_iov,
+    encode_kv_iov_bytes,
+    encode_tombstone,
 )
 
 
@@ -97,12 +101,27 @@ class TestEncodeKV:
         [
             KeyValue(10, "hello", "world", HEADER_SIZE + 10),
             KeyValue(0, "", "", HEADER_SIZE),
+            KeyValue(10, "včela", "med", HEADER_SIZE + 6 + 3),
         ],
     )
     def test_KV_serialisation(self, tt: KeyValue) -> None:
         self.kv_test(tt)
 
+    def test_iov(self) -> None:
+        sz, buffers = encode_kv_iov(10, "hello", "world")
+        assert sz == HEADER_SIZE + 10
+        assert buffers[1:] == [b"hello", b"world"]
+        assert b"".join(buffers) == encode_kv(10, "hello", "world")[1]
+        assert encode_kv_iov_bytes(10, b"hello", "world") == (sz, buffers)
+
     def test_random(self) -> None:
         for _ in range(100):
             tt = KeyValue(*get_random_kv())
             self.kv_test(tt)
+
+
+def test_tombstone() -> None:
+    data = encode_tombstone(10, "hello")
+    assert len(data) == HEADER_SIZE + 5
+    assert decode_header(data[:HEADER_SIZE]) == (10, 5, TOMBSTONE)
+    assert data[HEADER_SIZE:] == b"hello"